@@ -6,75 +6,142 @@ from ffcv.pipeline.operation import Operation
 from ffcv.pipeline.compiler import Compiler
 from ffcv.pipeline.state import State
 import numbers
-import numba as nb
+import torch
 from numba import njit
 
-@njit(parallel=False, fastmath=True, inline="always")
-def apply_cj(
-    im,
-    apply_bri,
-    bri_ratio,
-    apply_cont,
-    cont_ratio,
-    apply_sat,
-    sat_ratio,
-    apply_hue,
-    hue_factor,
-):
-
-    gray = (
-        np.float32(0.2989) * im[..., 0]
-        + np.float32(0.5870) * im[..., 1]
-        + np.float32(0.1140) * im[..., 2]
+@njit(inline="always")
+def splitmix64(x):
+    """Scramble a 64-bit integer into a well-mixed xorshift seed."""
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+@njit(inline="always")
+def xorshift_uniform(state, low, high):
+    """Advance a xorshift64 state and draw a float uniformly from [low, high)."""
+    state ^= state << np.uint64(13)
+    state ^= state >> np.uint64(7)
+    state ^= state << np.uint64(17)
+    u = np.float64(state >> np.uint64(11)) * (1.0 / 9007199254740992.0)
+    return state, low + (high - low) * u
+
+
+def make_apply_cj(apply_bri, apply_cont, apply_sat, apply_hue):
+    """Build the ColorJitter kernel for a fixed set of enabled ops.
+
+    The apply_* flags are frozen into the closure, so Numba sees them as
+    compile-time constants and drops the branches of disabled ops. The explicit
+    signature compiles the kernel eagerly, when the pipeline is built, for the
+    C-contiguous HWC uint8 images handed out by the FFCV decoders. It is called
+    (not inlined) from color_jitter, so that compiled version, with its own
+    fastmath flags, is the one that runs.
+    """
+
+    @njit(
+        "void(uint8[:,:,::1], float64, float64, float64, float64)",
+        parallel=False,
+        fastmath=True,
     )
-    one = np.float32(1)
-    # Brightness
-    if apply_bri:
-        im = im * bri_ratio
-
-    # Contrast
-    if apply_cont:
-        im = cont_ratio * im + (one - cont_ratio) * np.float32(gray.mean())
-
-    # Saturation
-    if apply_sat:
-        im[..., 0] = sat_ratio * im[..., 0] + (one - sat_ratio) * gray
-        im[..., 1] = sat_ratio * im[..., 1] + (one - sat_ratio) * gray
-        im[..., 2] = sat_ratio * im[..., 2] + (one - sat_ratio) * gray
-
-    # Hue
-    if apply_hue:
-        hue_factor_radians = hue_factor * 2.0 * np.pi
-        cosA = np.cos(hue_factor_radians)
-        sinA = np.sin(hue_factor_radians)
-        v1, v2, v3 = 1.0 / 3.0, np.sqrt(1.0 / 3.0), (1.0 - cosA)
-        hue_matrix = [
-            [
-                cosA + v3 / 3.0,
-                v1 * v3 - v2 * sinA,
-                v1 * v3 + v2 * sinA,
-            ],
-            [
-                v1 * v3 + v2 * sinA,
-                cosA + v1 * v3,
-                v1 * v3 - v2 * sinA,
-            ],
-            [
-                v1 * v3 - v2 * sinA,
-                v1 * v3 + v2 * sinA,
-                cosA + v1 * v3,
-            ],
-        ]
-        hue_matrix = np.array(hue_matrix, dtype=np.float64).T
-        for row in nb.prange(im.shape[0]):
-            im[row] = im[row] @ hue_matrix
-    return np.clip(im, 0, 255).astype(np.uint8)
+    def apply_cj(im, bri_ratio, cont_ratio, sat_ratio, hue_factor):
+        # All four ops are fused into a single pass over the image: every pixel is
+        # loaded once, jittered in float32 registers and written back in place.
+        one = np.float32(1)
+        zero = np.float32(0)
+        full = np.float32(255)
+        bri_ratio = np.float32(bri_ratio)
+        cont_ratio = np.float32(cont_ratio)
+        sat_ratio = np.float32(sat_ratio)
+        sat_scale = sat_ratio - one
+
+        # Contrast blends towards the mean gray level of the input image
+        cont_bias = zero
+        if apply_cont:
+            # Integer reduction with the fixed-point luminance weights of to_grayscale
+            gray_sum = 0
+            for row in range(im.shape[0]):
+                for col in range(im.shape[1]):
+                    gray_sum += 77 * im[row, col, 0] + 150 * im[row, col, 1] + 29 * im[row, col, 2]
+            gray_mean = np.float32(gray_sum / (256 * im.shape[0] * im.shape[1]))
+            cont_bias = (one - cont_ratio) * gray_mean
+
+        # Hue is a rotation around the gray axis, applied per pixel as
+        # [r, g, b] = M @ [r, g, b] with M kept in nine scalar locals
+        m00 = m11 = m22 = one
+        m01 = m02 = m10 = m12 = m20 = m21 = zero
+        if apply_hue:
+            hue_factor_radians = hue_factor * 2.0 * np.pi
+            cosA = np.cos(hue_factor_radians)
+            sinA = np.sin(hue_factor_radians)
+            k = (1.0 - cosA) / 3.0
+            q = np.sqrt(1.0 / 3.0) * sinA
+            m00 = m11 = m22 = np.float32(cosA + k)
+            m01 = m12 = m20 = np.float32(k - q)
+            m02 = m10 = m21 = np.float32(k + q)
+
+        for row in range(im.shape[0]):
+            for col in range(im.shape[1]):
+                r = np.float32(im[row, col, 0])
+                g = np.float32(im[row, col, 1])
+                b = np.float32(im[row, col, 2])
+                gray = np.float32(0.2989) * r + np.float32(0.5870) * g + np.float32(0.1140) * b
+                # Hue rotation leaves achromatic (r == g == b) pixels unchanged, since
+                # every row of the rotation matrix sums to 1
+                chromatic = r != g or g != b
+
+                # Brightness
+                if apply_bri:
+                    r = r * bri_ratio
+                    g = g * bri_ratio
+                    b = b * bri_ratio
+
+                # Contrast
+                if apply_cont:
+                    r = cont_ratio * r + cont_bias
+                    g = cont_ratio * g + cont_bias
+                    b = cont_ratio * b + cont_bias
+
+                # Saturation, as x + (x - gray) * (sat_ratio - 1)
+                if apply_sat:
+                    r += (r - gray) * sat_scale
+                    g += (g - gray) * sat_scale
+                    b += (b - gray) * sat_scale
+
+                # Hue
+                if apply_hue and chromatic:
+                    r, g, b = (
+                        m00 * r + m01 * g + m02 * b,
+                        m10 * r + m11 * g + m12 * b,
+                        m20 * r + m21 * g + m22 * b,
+                    )
+
+                im[row, col, 0] = np.uint8(min(max(r, zero), full))
+                im[row, col, 1] = np.uint8(min(max(g, zero), full))
+                im[row, col, 2] = np.uint8(min(max(b, zero), full))
+
+    return apply_cj
+
+
+@njit("void(uint8[:,:,::1])", fastmath=True, cache=True)
+def to_grayscale(im):
+    # Single pass: each pixel's luminance is written to its three channels in place.
+    # Luminance uses the BT.601 weights in 8-bit fixed point (77, 150, 29) / 256.
+    for row in range(im.shape[0]):
+        for col in range(im.shape[1]):
+            l = np.uint8((77 * im[row, col, 0] + 150 * im[row, col, 1] + 29 * im[row, col, 2] + 128) >> 8)
+            im[row, col, 0] = l
+            im[row, col, 1] = l
+            im[row, col, 2] = l
 
 
 class RandomColorJitter(Operation):
     """Add ColorJitter with probability jitter_prob.
     Operates on raw arrays (not tensors).
 
+    ffcv_tf jitters on the GPU with RandomColorJitterGrayscale; this Numba op is
+    kept as the CPU fallback for pipelines without a device stage.
+
     see https://github.com/pytorch/vision/blob/28557e0cfe9113a5285330542264f03e4ba74535/torchvision/transforms/functional_tensor.py#L165
      and https://sanje2v.wordpress.com/2021/01/11/accelerating-data-transforms/
     Parameters
@@ -155,22 +222,24 @@ class RandomColorJitter(Operation):
         apply_hue = self.apply_hue
         hue = self.hue
 
+        apply_cj = make_apply_cj(apply_bri, apply_cont, apply_sat, apply_hue)
+
         def color_jitter(images, _):
+            # Each image draws from its own xorshift stream, seeded from one draw
+            # of Numba's global generator per batch, so workers share no RNG state.
+            # That generator is separate from numpy's: np.random.seed does not fix it.
+            seed = np.uint64(np.random.randint(0, 2 ** 62))
             for i in my_range(images.shape[0]):
-                if np.random.rand() > jitter_prob:
+                state = splitmix64(seed + np.uint64(i))
+                state, u = xorshift_uniform(state, 0.0, 1.0)
+                if u > jitter_prob:
                     continue
 
-                images[i] = apply_cj(
-                    images[i].astype("float64"),
-                    apply_bri,
-                    np.random.uniform(bri[0], bri[1]),
-                    apply_cont,
-                    np.random.uniform(cont[0], cont[1]),
-                    apply_sat,
-                    np.random.uniform(sat[0], sat[1]),
-                    apply_hue,
-                    np.random.uniform(hue[0], hue[1]),
-                )
+                state, bri_ratio = xorshift_uniform(state, bri[0], bri[1])
+                state, cont_ratio = xorshift_uniform(state, cont[0], cont[1])
+                state, sat_ratio = xorshift_uniform(state, sat[0], sat[1])
+                state, hue_factor = xorshift_uniform(state, hue[0], hue[1])
+                apply_cj(images[i], bri_ratio, cont_ratio, sat_ratio, hue_factor)
             return images
 
         color_jitter.is_parallel = True
@@ -185,6 +254,9 @@ class RandomGrayscale(Operation):
     '''
     Randomly convert image to grayscale with a probability of p (not tensors).
 
+    ffcv_tf converts on the GPU with RandomColorJitterGrayscale; this Numba op is
+    kept as the CPU fallback for pipelines without a device stage.
+
     Parameters
     ----------
     p : float
@@ -201,13 +273,13 @@ class RandomGrayscale(Operation):
         def rgb_to_grayscale(images, *_):
 
             apply_grayscale = np.random.rand(images.shape[0]) < p
-            for i in my_range(images.shape[0]):
-                if apply_grayscale[i]:
-                    r, g, b = images[i,:,:,0], images[i,:,:,1], images[i,:,:,2]
-                    l_img = (0.2989 * r + 0.587 * g + 0.114 * b).astype(images[i].dtype)
-                    l_img = np.expand_dims(l_img, axis=-1)
-                    l_img = np.broadcast_to(l_img, images[0].shape)
-                    images[i] = l_img
+            # Most batches only convert a few images, or none at all
+            selected = np.flatnonzero(apply_grayscale)
+            if selected.shape[0] == 0:
+                return images
+
+            for j in my_range(selected.shape[0]):
+                to_grayscale(images[selected[j]])
 
             return images
 
@@ -215,4 +287,125 @@ class RandomGrayscale(Operation):
         return rgb_to_grayscale
 
     def declare_state_and_memory(self, previous_state):
-        return (replace(previous_state, jit_mode=True), AllocationQuery(previous_state.shape, previous_state.dtype))
\ No newline at end of file
+        return (replace(previous_state, jit_mode=True), AllocationQuery(previous_state.shape, previous_state.dtype))
+
+
+class RandomColorJitterGrayscale(RandomColorJitter):
+    """GPU version of RandomColorJitter followed by RandomGrayscale.
+    Operates on uint8 (N, H, W, C) tensors on device (after ToDevice).
+
+    Per-image factors are drawn with a single torch.rand call on the device, and
+    the whole batch is jittered with batched elementwise ops, so no per-image
+    work is left on the CPU loader workers. Images not selected for jitter get
+    identity factors. Results match the CPU ops up to float rounding: the
+    contrast mean and the grayscale conversion use the same fixed-point
+    luminance as apply_cj and to_grayscale.
+
+    Parameters
+    ----------
+    jitter_prob, brightness, contrast, saturation, hue : see RandomColorJitter.
+    grayscale_p : float, probability to convert an image to grayscale.
+    """
+
+    def __init__(
+        self,
+        jitter_prob=0.5,
+        brightness=0.8,
+        contrast=0.4,
+        saturation=0.4,
+        hue=0.2,
+        grayscale_p=0.1
+    ):
+        super().__init__(jitter_prob, brightness, contrast, saturation, hue)
+        self.grayscale_p = grayscale_p
+        assert self.grayscale_p >= 0 and self.grayscale_p <= 1
+
+    def generate_code(self) -> Callable:
+        jitter_prob = self.jitter_prob
+        grayscale_p = self.grayscale_p
+
+        apply_bri = self.apply_brightness
+        bri = self.brightness
+
+        apply_cont = self.apply_contrast
+        cont = self.contrast
+
+        apply_sat = self.apply_saturation
+        sat = self.saturation
+
+        apply_hue = self.apply_hue
+        hue = self.hue
+
+        def luminance(x):
+            return 0.2989 * x[..., 0] + 0.587 * x[..., 1] + 0.114 * x[..., 2]
+
+        def fixed_luminance(x):
+            # (77 r + 150 g + 29 b) / 256, exact in float32 for integer pixels
+            return (77.0 * x[..., 0] + 150.0 * x[..., 1] + 29.0 * x[..., 2]) * (1.0 / 256.0)
+
+        def color_jitter_grayscale(images, dst):
+            B = images.shape[0]
+            dst = dst[:B]
+
+            # Columns: jitter coin, brightness, contrast, saturation, hue, grayscale coin
+            u = torch.rand((B, 6), device=images.device)
+            jitter = u[:, 0] < jitter_prob
+
+            def factor(col, bounds, identity):
+                f = bounds[0] + (bounds[1] - bounds[0]) * u[:, col]
+                return torch.where(jitter, f, torch.full_like(f, identity)).view(B, 1, 1, 1)
+
+            # One float32 working buffer, updated in place by each op except hue,
+            # whose bmm writes a new one. Saturation also keeps the pre-jitter
+            # luminance, a single-channel (N, H, W, 1) buffer.
+            x = images.to(torch.float32)
+            if apply_sat:
+                gray = luminance(x).unsqueeze(-1)
+            if apply_cont:
+                gray_mean = fixed_luminance(x).mean(dim=(1, 2), keepdim=True)
+
+            # Brightness
+            if apply_bri:
+                x.mul_(factor(1, bri, 1.0))
+
+            # Contrast
+            if apply_cont:
+                cont_ratio = factor(2, cont, 1.0)
+                x.mul_(cont_ratio).add_((1.0 - cont_ratio) * gray_mean.unsqueeze(-1))
+
+            # Saturation, as sat_ratio * x + (1 - sat_ratio) * gray
+            if apply_sat:
+                sat_ratio = factor(3, sat, 1.0)
+                x.mul_(sat_ratio).addcmul_(gray, 1.0 - sat_ratio)
+
+            # Hue, as a batch of 3x3 rotations around the gray axis
+            if apply_hue:
+                hue_factor_radians = factor(4, hue, 0.0).view(B) * 2.0 * np.pi
+                cosA = torch.cos(hue_factor_radians)
+                sinA = torch.sin(hue_factor_radians)
+                k = (1.0 - cosA) / 3.0
+                q = np.sqrt(1.0 / 3.0) * sinA
+                diag, minus, plus = cosA + k, k - q, k + q
+                hue_matrix = torch.stack(
+                    [diag, minus, plus, plus, diag, minus, minus, plus, diag], dim=1
+                ).view(B, 3, 3)
+                x = torch.bmm(x.view(B, -1, 3), hue_matrix.transpose(1, 2)).view_as(x)
+
+            x.clamp_(0, 255).trunc_()
+
+            # Grayscale
+            to_gray = (u[:, 5] < grayscale_p).to(torch.float32).view(B, 1, 1, 1)
+            x.lerp_(fixed_luminance(x).add_(0.5).floor_().unsqueeze(-1), to_gray)
+
+            dst.copy_(x)
+            return dst
+
+        return color_jitter_grayscale
+
+    def declare_state_and_memory(
+        self, previous_state: State
+    ) -> Tuple[State, Optional[AllocationQuery]]:
+        return (
+            replace(previous_state, jit_mode=False),
+            AllocationQuery(previous_state.shape, previous_state.dtype, device=previous_state.device),
+        )
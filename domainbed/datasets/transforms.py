@@ -1,9 +1,10 @@
 from torchvision import transforms as T
 
+import numpy as np
 import torch
-from domainbed.datasets.ffcv_transforms import RandomGrayscale, RandomColorJitter
+from domainbed.datasets.ffcv_transforms import RandomColorJitterGrayscale
 from ffcv.fields.decoders import IntDecoder, CenterCropRGBImageDecoder, RandomResizedCropRGBImageDecoder
-from ffcv.transforms import RandomHorizontalFlip, Convert, ToDevice, ToTensor, ToTorchImage
+from ffcv.transforms import RandomHorizontalFlip, NormalizeImage, ToDevice, ToTensor, ToTorchImage
 from ffcv.transforms.common import Squeeze
 
 basic = T.Compose(
@@ -26,30 +27,28 @@ aug = T.Compose(
 
 def ffcv_tf(device=torch.device('cuda'), use_amp=True):
 
-    mean = [0.485 * 255, 0.456 * 255, 0.406 * 255]
-    std = [0.229 * 255, 0.224 * 255, 0.225 * 255]
+    mean = np.array([0.485, 0.456, 0.406]) * 255
+    std = np.array([0.229, 0.224, 0.225]) * 255
+    dtype = np.float16 if use_amp else np.float32
 
-    label_pipeline = [IntDecoder(), ToTensor(), ToDevice(device), Squeeze()]
+    label_pipeline = [IntDecoder(), ToTensor(), ToDevice(device, non_blocking=True), Squeeze()]
 
     aug_image_pipeline = [
         RandomResizedCropRGBImageDecoder(output_size=(224, 224), scale=(0.7, 1.0), ratio=(3 / 4, 4 / 3)),
         RandomHorizontalFlip(),
-        RandomColorJitter(1.0, 0.3, 0.3, 0.3, 0.3),
-        RandomGrayscale(0.1),
         ToTensor(),
-        ToDevice(device, non_blocking=True),
+        ToDevice(device, non_blocking=True), # uint8 on the wire, 1 byte per channel
+        RandomColorJitterGrayscale(1.0, 0.3, 0.3, 0.3, 0.3, grayscale_p=0.1),
         ToTorchImage(),
-        Convert(torch.float16 if use_amp else torch.float32),
-        T.Normalize(mean=mean, std=std), # Normalize using image statistics
+        NormalizeImage(mean, std, dtype), # Normalize using image statistics
     ]
 
     basic_image_pipeline = [
         CenterCropRGBImageDecoder(output_size=(224, 224), ratio=1.0),
         ToTensor(),
-        ToDevice(device, non_blocking=True),
+        ToDevice(device, non_blocking=True), # uint8 on the wire, 1 byte per channel
         ToTorchImage(),
-        Convert(torch.float16 if use_amp else torch.float32),
-        T.Normalize(mean=mean, std=std), # Normalize using image statistics
+        NormalizeImage(mean, std, dtype), # Normalize using image statistics
     ]
 
     return aug_image_pipeline, basic_image_pipeline, label_pipeline
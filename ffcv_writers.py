@@ -1,25 +1,42 @@
 from pathlib import Path
 import argparse
+import multiprocessing
+import os
 from domainbed.datasets import datasets
 
 from ffcv.fields import IntField, RGBImageField
 from ffcv.writer import DatasetWriter
 
 
+def write_env(env, ds, num_workers):
+    print(f'Writting {env} beton file')
+    writer = DatasetWriter(Path(ds.root)/f'{env}.beton', {
+        'image': RGBImageField(),
+        'label': IntField()
+    }, num_workers=num_workers)
+    writer.from_indexed_dataset(ds)
+
+
 def write(args):
     
     dataset = vars(datasets)[args.dataset](args.data_dir)
     print(f'Writting beton files for {args.dataset} dataset')
 
-    for env, ds in zip(dataset.environments, dataset.datasets):
-        print(f'Writting {env} beton file')
-        writer = DatasetWriter(Path(ds.root)/f'{env}.beton', {
-            'image': RGBImageField(),
-            'label': IntField()
-        })
-        writer.from_indexed_dataset(ds)   
+    # Environments are written concurrently, sharing the cores between them.
+    # Plain (non-daemonic) processes are used since DatasetWriter starts its own workers.
+    num_workers = max(1, os.cpu_count() // len(dataset.environments))
+    procs = [
+        multiprocessing.Process(target=write_env, args=(env, ds, num_workers))
+        for env, ds in zip(dataset.environments, dataset.datasets)
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
 
-    pass
+    failed = [env for env, proc in zip(dataset.environments, procs) if proc.exitcode != 0]
+    if failed:
+        raise RuntimeError(f'Failed to write beton files for {failed}')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="ffcv writer")